@@ -1,3 +1,4 @@
+import asyncio
 import os
 import logging
 from dotenv import load_dotenv
@@ -7,6 +8,7 @@ from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Messa
 from supabase import create_client, Client
 from groq import Groq
 import operator
+import re
 from pydantic import BaseModel, Field
 from typing import Annotated, List, Literal
 from typing_extensions import TypedDict
@@ -16,6 +18,10 @@ from langchain_groq import ChatGroq
 
 from langgraph.graph import END, MessagesState, START, StateGraph
 
+from conversations import ConversationStore
+from dispatch import UserDispatcher
+from metrics import TokenUsageHandler, instrument_node, start_metrics_server, track_call, track_request
+
 load_dotenv()
 
 url = os.getenv("SUPABASE_URL")
@@ -23,7 +29,7 @@ key = os.getenv("SUPABASE_KEY")
 
 supabase: Client = create_client(url, key)
 groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-llm = ChatGroq(model="llama-3.3-70b-versatile")
+llm = ChatGroq(model="llama-3.3-70b-versatile", callbacks=[TokenUsageHandler()])
 
 class Sale(TypedDict):
     deal_name:str
@@ -37,14 +43,31 @@ class Recipe(TypedDict):
     ingredient_on_sale:int
     total_ingredients:int
 
+RECIPE_PAGE_SIZE = 50
+#stop fetching pages once this many filtered recipes are cached, keeps the checkpoint small.
+#the page that crosses it is kept whole, so a search caches at most CACHE_FILL_TARGET + RECIPE_PAGE_SIZE - 1
+CACHE_FILL_TARGET = 60
+
+#state is checkpointed per user, so these reducers see the previous turn's values
+def extend_or_reset(current:list, update:list|None):
+    # None clears the cached candidates (new search or changed dislikes)
+    # never truncate here: supabase_offset already points past every page that was added
+    if update is None:
+        return []
+    return current + update
+
+def merge_unique(current:list, update:list):
+    return list(dict.fromkeys(current + update))
+
 class ShopperState(TypedDict):
     user_id:str
     user_text:str #can change later to list once longer conversations
     user_intent:str
     recipes: List[Recipe]
-    matched_recipes:Annotated[list,operator.add]
-    dislikes:Annotated[list,operator.add]
+    matched_recipes:Annotated[list,extend_or_reset]
+    dislikes:Annotated[list,merge_unique]
     supabase_offset:int #for scrolling if first 50 don't work out
+    shown_count:int #how many of matched_recipes the user has already seen
     final_response:str
 
 
@@ -69,35 +92,70 @@ class PrettyResponse(BaseModel):
 
 
 #extract any dislikes for filtering
-def profile_node(state:ShopperState):
+@instrument_node
+async def profile_node(state:ShopperState):
     user_text = state['user_text']
     user_id = state['user_id']
-    response = llm.with_structured_output(UpdatePreferences).invoke([
-        ("system", "Extract any ingredients the user dislikes or cannot eat."),
-        ("human",user_text)
-    ])
+    #loaded here rather than per message so cached follow-ups skip the read
+    try:
+        with track_call("supabase", "fetch_dislikes"):
+            prefs = await asyncio.to_thread(supabase.table("user_preferences").select("dislikes").eq("user_id", user_id).execute)
+        raw_dislikes = prefs.data[0]['dislikes'] if prefs.data else []
+        existing_dislikes = list(set([d for d in raw_dislikes if d and d.strip()]))
+    except Exception as e:
+        print(f"Memory Fetch Error: {e}")
+        existing_dislikes = []
+    with track_call("groq", "extract_dislikes"):
+        response = await llm.with_structured_output(UpdatePreferences).ainvoke([
+            ("system", "Extract any ingredients the user dislikes or cannot eat."),
+            ("human",user_text)
+        ])
     if response.new_dislikes:
-        updated_list = list(set(state['dislikes'] + response.new_dislikes))
+        updated_list = list(set(state.get('dislikes', []) + existing_dislikes + response.new_dislikes))
         if user_id:
             try:
-                supabase.table("user_preferences").upsert({
-                    "user_id": user_id, 
-                    "dislikes": updated_list 
-                }).execute()
+                with track_call("supabase", "upsert_preferences"):
+                    await asyncio.to_thread(supabase.table("user_preferences").upsert({
+                        "user_id": user_id, 
+                        "dislikes": updated_list 
+                    }).execute)
                 print(f"Saved prefs for {user_id}")
             except Exception as e:
                 print(f"Save Error: {e}")
-    return {"dislikes":response.new_dislikes}
+        # cached candidates were filtered against the old dislikes
+        return {"dislikes":existing_dislikes + response.new_dislikes, "matched_recipes":None, "supabase_offset":0, "shown_count":0}
+    return {"dislikes":existing_dislikes}
 
-def user_intent_node(state:ShopperState):
+@instrument_node
+async def user_intent_node(state:ShopperState):
     user_text = state['user_text']
     #determine intent
-    response = llm.with_structured_output(UserIntent).invoke([
-        ("system", "You are a router. Determine if the user wants to search for recipes, just update their profile, or is chatting."),
-        ("human",user_text)
-    ])
+    with track_call("groq", "classify_intent"):
+        response = await llm.with_structured_output(UserIntent).ainvoke([
+            ("system", "You are a router. Determine if the user wants to search for recipes, just update their profile, or is chatting."),
+            ("human",user_text)
+        ])
+    if response.intent == "recipe":
+        # fresh search, forget the previous one
+        return {"user_intent":response.intent, "matched_recipes":None, "supabase_offset":0, "shown_count":0}
     return {"user_intent":response.intent}
 
+#"more options", "show me more", "next please"... anything longer goes through the llm router
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(please\s+)?((show|give)\s+me\s+|any\s+)?(some\s+)?(more|next|other|another|different)"
+    r"(\s+(options?|recipes?|ones?|meals?|ideas?|please))*\s*[.!?]*\s*$",
+    re.IGNORECASE,
+)
+
+#follow-ups page through the cached search and skip the profile/intent llm calls
+def follow_up_conditional(state:ShopperState):
+    has_search = state.get("supabase_offset", 0) > 0
+    if not has_search or not FOLLOW_UP_PATTERN.match(state['user_text']):
+        return "profile_node"
+    if state.get("shown_count", 0) < len(state.get("matched_recipes", [])):
+        return "final_recipes_node"
+    return "database_node"
+
 def intent_conditional(state:ShopperState):
     intent = state['user_intent']
     if intent == "recipe":
@@ -106,31 +164,38 @@ def intent_conditional(state:ShopperState):
 
 
 
-def database_node(state:ShopperState):
+@instrument_node
+async def database_node(state:ShopperState):
     protein = 40
     calories = 5000
     offset = state.get("supabase_offset", 0)
     print("attempting to grab recipes")
     try:
-        recipe_response = supabase. \
-            rpc('recommend_recipes',
-                {'min_protein_g':protein,
-                'max_calories':calories,
-                'min_match_percent':.20,
-                'limit_count': 50,
-                'offset_val':offset
-                }). \
-                execute()
-        return {
+        with track_call("supabase", "recommend_recipes"):
+            recipe_response = await asyncio.to_thread(supabase. \
+                rpc('recommend_recipes',
+                    {'min_protein_g':protein,
+                    'max_calories':calories,
+                    'min_match_percent':.20,
+                    'limit_count': RECIPE_PAGE_SIZE,
+                    'offset_val':offset
+                    }). \
+                    execute)
+        update = {
             "recipes":recipe_response.data or [],
-            "supabase_offset": offset + 50
+            "supabase_offset": offset + RECIPE_PAGE_SIZE
             }
+        #everything cached has been shown ("more" past the end), start a fresh page of candidates
+        if state.get("shown_count", 0) >= len(state.get("matched_recipes", [])):
+            update.update({"matched_recipes":None, "shown_count":0})
+        return update
     except Exception as e:
         print(f"Failed to get recipes: {e}")
         return {"recipes":[]}
 #here i filter to make sure the recipes don't contain disliked ingredients
 #greater filtering will be added if too many recipes pass first filter test
-def filter_node(state: ShopperState):
+@instrument_node
+async def filter_node(state: ShopperState):
     recipes = state.get('recipes', [])
     dislikes = state.get('dislikes', [])
     
@@ -159,10 +224,11 @@ def filter_node(state: ShopperState):
     """
     
     try:
-        response = llm.with_structured_output(FilterResult).invoke([
-            ("system", system_prompt),
-            ("human", batch_text)
-        ])
+        with track_call("groq", "filter_recipes"):
+            response = await llm.with_structured_output(FilterResult).ainvoke([
+                ("system", system_prompt),
+                ("human", batch_text)
+            ])
         
         valid_recipes = [recipes[i] for i in response.safe_indices if i < len(recipes)]
         print(f"Filter removed {len(recipes) - len(valid_recipes)} recipes.")
@@ -176,22 +242,34 @@ def filter_node(state: ShopperState):
 def filtered_conditional(state:ShopperState):
     recipes = state['matched_recipes']
     
+    #empty page or failed rpc: the database has nothing more, show what we have instead of looping
+    if not state.get('recipes'):
+        return "final_recipes_node"
+    #enough cached, the cursor sits right after the last page we kept
+    if len(recipes) >= CACHE_FILL_TARGET:
+        return "final_recipes_node"
     if len(recipes) <=3 or state['supabase_offset'] <= 250:
         return "database_node"
     else:
         return "final_recipes_node"
     
 #return final list in chat format
-def final_recipes_node(state:ShopperState):
-    matched_recipes = state['matched_recipes'][:5] # Limit to 5 responses
+@instrument_node
+async def final_recipes_node(state:ShopperState):
+    shown = state.get('shown_count', 0)
+    matched_recipes = state.get('matched_recipes', [])[shown:shown + 5] # Limit to 5 responses
+    if not matched_recipes:
+        return {"final_response": "That's everything I found for now! Ask me for something different.", "recipes": []}
     #Distinguish clearly between 'On Sale' items and 'Regular Price' items. (include when available)
     system_prompt = "You are a helpful shopping assistant. Present these meal options nicely. Ensure the recipe names are generic while still being accurate. Group the shopping list by category if possible. "
-    response = llm.with_structured_output(PrettyResponse).invoke([
-        ("system",system_prompt),
-        ("human",str(matched_recipes))
-    ])
+    with track_call("groq", "render_recipes"):
+        response = await llm.with_structured_output(PrettyResponse).ainvoke([
+            ("system",system_prompt),
+            ("human",str(matched_recipes))
+        ])
         
-    return {"final_response": response.recipe_text}
+    # raw db page isn't needed once filtered, don't carry it in the checkpoint
+    return {"final_response": response.recipe_text, "shown_count": shown + len(matched_recipes), "recipes": []}
 
 
 
@@ -205,14 +283,20 @@ shopping_builder.add_node(final_recipes_node)
 
 
 #flow
-shopping_builder.add_edge(START, "profile_node")
+shopping_builder.add_conditional_edges(START, follow_up_conditional)
 shopping_builder.add_edge("profile_node", "user_intent_node")
 shopping_builder.add_conditional_edges("user_intent_node",intent_conditional)
 shopping_builder.add_edge("database_node", "filter_node")
 shopping_builder.add_conditional_edges("filter_node",filtered_conditional)
 shopping_builder.add_edge("final_recipes_node",END)
 
+# recompiled with a checkpointer once the conversation store is open (see startup)
 app_graph = shopping_builder.compile()
+conversations = ConversationStore(
+    os.getenv("CHECKPOINT_DB", "checkpoints.sqlite"), #point at a mounted volume in production
+    ttl=float(os.getenv("CONVERSATION_TTL", str(6 * 3600))),
+    max_threads=int(os.getenv("MAX_CONVERSATIONS", "5000")),
+)
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -221,7 +305,8 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Start command received from {user_id}")
     try:
         # Check if user already exists in DB
-        response = supabase.table("user_preferences").select("user_id").eq("user_id", user_id).execute()
+        with track_call("supabase", "lookup_user"):
+            response = await asyncio.to_thread(supabase.table("user_preferences").select("user_id").eq("user_id", user_id).execute)
         
         # If no data returned, they are NEW
         if not response.data:
@@ -236,10 +321,11 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
             # SAVE them to DB
-            supabase.table("user_preferences").insert({
-                "user_id": user_id, 
-                "dislikes": []
-            }).execute()
+            with track_call("supabase", "insert_user"):
+                await asyncio.to_thread(supabase.table("user_preferences").insert({
+                    "user_id": user_id, 
+                    "dislikes": []
+                }).execute)
             
             await update.message.reply_text(welcome_message)
             
@@ -251,37 +337,32 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Fallback in case DB fails
         await update.message.reply_text("👋 Hello! Ask me for recipes.")
 
-async def telegram_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_text = update.message.text
-    #chat_id = update.message.chat_id
-    user_id = update.message.from_user.id
+async def run_chat(user_id, user_text):
     print(f"Received: {user_text}")
-    try:
-        response = supabase.table("user_preferences").select("dislikes").eq("user_id", user_id).execute()
-        raw_dislikes = response.data[0]['dislikes'] if response.data else []
-        existing_dislikes = list(set([d for d in raw_dislikes if d and d.strip()]))
-    except Exception as e:
-        print(f"Memory Fetch Error: {e}")
-        existing_dislikes = []
-    
     # 1. Initialize State
-    initial_state = {
+    # search results and the pagination cursor are left out so the checkpointed ones carry over
+    turn_input = {
         "user_id":user_id,
         "user_text": user_text,
         "user_intent": "",
-        "recipes": [],
-        "matched_recipes": [],
-        "dislikes": existing_dislikes, 
-        "supabase_offset": 0,
         "final_response": ""
     }
     
     # 2. Run the Graph (Invoke)
     # This runs the whole flow we just built
-
-    final_state = await app_graph.ainvoke(initial_state)
+    await conversations.expire_if_stale(user_id)
+    loaded = await conversations.latest_checkpoint(user_id)
+    try:
+        with track_request("chat"):
+            # only the end of a turn needs saving
+            final_state = await app_graph.ainvoke(turn_input, conversations.config(user_id), durability="exit")
+    except asyncio.CancelledError:
+        # a superseded run still saves its partial state on exit, throw it away so the next turn starts clean
+        await asyncio.shield(conversations.rollback(user_id, loaded))
+        raise
+    await conversations.touch(user_id)
     
-    # 3. Send the Result
+    # 3. Build the Result
     response = final_state.get("final_response")
     
     # Fallback if the graph ended early (e.g., just profile update)
@@ -290,13 +371,66 @@ async def telegram_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response = "Got it! I've updated your preferences."
         else:
             response = "I'm mostly a shopping bot. Ask me for recipes!"
-            
-    await update.message.reply_text(response)
+    return response
+
+# bursts from one user get merged into a single graph run and rate limited
+dispatcher = UserDispatcher(
+    run_chat,
+    coalesce_window=float(os.getenv("COALESCE_WINDOW", "0.75")),
+    rate=float(os.getenv("USER_RATE_PER_SEC", "0.5")),
+    burst=int(os.getenv("USER_BURST", "5")),
+    max_supersedes=int(os.getenv("MAX_SUPERSEDES", "2")),
+    max_wait=float(os.getenv("MAX_REPLY_WAIT", "10")),
+    max_merged=int(os.getenv("MAX_MERGED_MESSAGES", "3")),
+)
 
-# --- RUN ---
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+async def telegram_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_text = update.message.text
+    #chat_id = update.message.chat_id
+    user_id = update.message.from_user.id
+    # returns straight away, the dispatcher replies once the graph finishes
+    accepted = await dispatcher.submit(user_id, user_text, update.message.reply_text)
+    if not accepted and dispatcher.should_warn(user_id):
+        await update.message.reply_text("Whoa, that's a lot of messages! Give me a few seconds to catch up.")
+
+async def startup(app):
+    global app_graph
+    await conversations.open()
+    app_graph = shopping_builder.compile(checkpointer=conversations.saver)
+
+async def shutdown(app):
+    await dispatcher.drain()
+    await conversations.close()
+
+def build_application():
+    builder = ApplicationBuilder().token(os.getenv("TELEGRAM_BOT_TOKEN")).post_init(startup).post_shutdown(shutdown)
+    # point at a local stand-in (see telegram_standin.py) instead of api.telegram.org
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_handler))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), telegram_handler))
-    print("Bot is polling...")
-    app.run_polling()
\ No newline at end of file
+    return app
+
+# --- RUN ---
+if __name__ == '__main__':
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        start_metrics_server(int(metrics_port))
+    app = build_application()
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        # per-user state lives in this process; for more than one worker put router.py in front
+        port = int(os.getenv("PORT", "8443"))
+        print(f"Bot is serving webhook on port {port}...")
+        app.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=port,
+            url_path=os.getenv("WEBHOOK_PATH", "telegram"),
+            webhook_url=os.getenv("WEBHOOK_URL"),
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")),
+        )
+    else:
+        print("Bot is polling...")
+        app.run_polling()
@@ -0,0 +1,135 @@
+import os
+import time
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+
+class ConversationStore:
+    """Per-user graph checkpoints in SQLite so follow-ups can reuse the last search.
+
+    Each user is one langgraph thread. Only the latest checkpoint of a thread is
+    kept, threads idle for longer than `ttl` seconds are dropped, and past
+    `max_threads` the least recently active users are evicted.
+
+    The SQLite file is local to one process, so keep `path` on a persistent
+    volume per worker. With several workers, router.py shards updates by user id,
+    so each user's thread only ever lives in one worker's file.
+    """
+
+    def __init__(self, path, ttl=6 * 3600, max_threads=5000):
+        self.path = path
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self.saver = None
+        self._turns = 0
+
+    async def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = await aiosqlite.connect(self.path)
+        self.saver = AsyncSqliteSaver(conn)
+        await self.saver.setup()
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_activity (thread_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)"
+        )
+        await conn.commit()
+        await self.prune()
+
+    async def close(self):
+        if self.saver:
+            await self.saver.conn.close()
+            self.saver = None
+
+    def config(self, user_id):
+        return {"configurable": {"thread_id": str(user_id)}}
+
+    async def expire_if_stale(self, user_id):
+        """Forget the user's state if they have been away longer than the TTL."""
+        if not self.saver:
+            return
+        thread_id = str(user_id)
+        async with self.saver.conn.execute(
+            "SELECT last_seen FROM thread_activity WHERE thread_id = ?", (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row and row[0] < time.time() - self.ttl:
+            await self._delete(thread_id)
+
+    async def latest_checkpoint(self, user_id):
+        """Id of the user's newest checkpoint, or None if there is none."""
+        if not self.saver:
+            return None
+        async with self.saver.conn.execute(
+            "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ?", (str(user_id),)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def rollback(self, user_id, checkpoint_id):
+        """Drop checkpoints written after `checkpoint_id` (all of them if None).
+
+        A cancelled run still saves its partial state on exit, and the next
+        turn must not load that half-finished state.
+        """
+        if not self.saver:
+            return
+        thread_id = str(user_id)
+        conn = self.saver.conn
+        for table in ("checkpoints", "writes"):
+            await conn.execute(
+                f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_id > ?", (thread_id, checkpoint_id or "")
+            )
+        await conn.commit()
+
+    async def touch(self, user_id):
+        """Record activity and drop every checkpoint but the newest for this user."""
+        if not self.saver:
+            return
+        thread_id = str(user_id)
+        conn = self.saver.conn
+        # checkpoint ids are time-ordered uuids, so the max is the latest
+        await conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id < "
+            "(SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ?)",
+            (thread_id, thread_id),
+        )
+        await conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_id NOT IN "
+            "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ?)",
+            (thread_id, thread_id),
+        )
+        await conn.execute(
+            "INSERT INTO thread_activity (thread_id, last_seen) VALUES (?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (thread_id, time.time()),
+        )
+        await conn.commit()
+        self._turns += 1
+        if self._turns % 100 == 0:
+            await self.prune()
+
+    async def prune(self):
+        """Delete expired threads, then the oldest ones beyond max_threads."""
+        if not self.saver:
+            return
+        conn = self.saver.conn
+        async with conn.execute(
+            "SELECT thread_id FROM thread_activity WHERE last_seen < ?", (time.time() - self.ttl,)
+        ) as cursor:
+            expired = [row[0] for row in await cursor.fetchall()]
+        async with conn.execute(
+            "SELECT thread_id FROM thread_activity WHERE last_seen >= ? ORDER BY last_seen DESC LIMIT -1 OFFSET ?",
+            (time.time() - self.ttl, self.max_threads),
+        ) as cursor:
+            evicted = [row[0] for row in await cursor.fetchall()]
+        for thread_id in expired + evicted:
+            await self._delete(thread_id)
+        if expired or evicted:
+            print(f"Pruned {len(expired)} expired and {len(evicted)} evicted conversations")
+
+    async def _delete(self, thread_id):
+        await self.saver.adelete_thread(thread_id)
+        await self.saver.conn.execute("DELETE FROM thread_activity WHERE thread_id = ?", (thread_id,))
+        await self.saver.conn.commit()
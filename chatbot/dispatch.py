@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from metrics import DISPATCH_MESSAGES, SUPERSEDED_RUNS
+
+
+class TokenBucket:
+    """Allows `burst` messages at once, refilling at `rate` messages per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.warned = False  # whether the user has been told they are throttled since the last refill
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.warned = False
+        return True
+
+
+class UserDispatcher:
+    """Per-user queue in front of the graph.
+
+    Messages that arrive within `coalesce_window` seconds of each other are merged
+    into one graph run, and a new message cancels the user's in-flight run so only
+    the latest context gets answered. Cancelling is bounded so a steady sender still
+    gets replies: once a run has been superseded `max_supersedes` times, or the
+    oldest unanswered message has waited `max_wait` seconds, new messages queue
+    behind the in-flight run instead. Only the last `max_merged` texts go into a
+    prompt. Each user is also rate limited with a token bucket.
+
+    All of this state is in memory, so every message from a user has to reach the
+    same process. With several workers, put router.py in front to shard updates by
+    user id.
+    """
+
+    def __init__(self, process, coalesce_window=0.75, rate=0.5, burst=5, max_supersedes=2, max_wait=10.0,
+                 max_merged=3, error_text="Sorry, something went wrong on my end. Try again in a moment!"):
+        # process(user_id, text) -> reply text
+        self.process = process
+        self.error_text = error_text
+        self.coalesce_window = coalesce_window
+        self.rate = rate
+        self.burst = burst
+        self.max_supersedes = max_supersedes
+        self.max_wait = max_wait
+        self.max_merged = max_merged
+        self._seq = 0
+        self._buckets = {}
+        self._pending = {}  # user_id -> [(seq, text, reply), ...] not yet answered, at most max_merged
+        self._waiting_since = {}  # user_id -> arrival of the oldest unanswered message
+        self._superseded = {}  # user_id -> runs cancelled since the user was last answered
+        self._tasks = {}  # user_id -> in-flight asyncio.Task
+
+    def allow(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune_buckets()
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    def _prune_buckets(self):
+        # a bucket that has refilled completely is the same as no bucket at all
+        now = time.monotonic()
+        for user_id, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[user_id]
+
+    def should_warn(self, user_id):
+        """True at most once per refill, so a flood gets one throttle notice rather than one per message."""
+        bucket = self._buckets.get(user_id)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    def _may_cancel(self, user_id):
+        if self._superseded.get(user_id, 0) >= self.max_supersedes:
+            return False
+        return time.monotonic() - self._waiting_since[user_id] < self.max_wait
+
+    async def submit(self, user_id, text, reply):
+        """Queue a message; returns False if the user is over their rate limit."""
+        if not self.allow(user_id):
+            DISPATCH_MESSAGES.inc(outcome="throttled")
+            return False
+        DISPATCH_MESSAGES.inc(outcome="accepted")
+        self._seq += 1
+        pending = self._pending.setdefault(user_id, [])
+        pending.append((self._seq, text, reply))
+        # older texts beyond the cap are dropped rather than growing the prompt
+        del pending[:-self.max_merged]
+        self._waiting_since.setdefault(user_id, time.monotonic())
+
+        in_flight = self._tasks.get(user_id)
+        if in_flight and not in_flight.done():
+            if not self._may_cancel(user_id):
+                # the in-flight run answers first, then picks this message up (see _run)
+                return True
+            SUPERSEDED_RUNS.inc()
+            self._superseded[user_id] = self._superseded.get(user_id, 0) + 1
+            in_flight.cancel()
+        else:
+            in_flight = None
+        self._tasks[user_id] = asyncio.create_task(self._run(user_id, in_flight))
+        return True
+
+    def _answered(self, user_id, seq):
+        remaining = [p for p in self._pending.get(user_id, []) if p[0] > seq]
+        self._superseded.pop(user_id, None)
+        if remaining:
+            self._pending[user_id] = remaining
+            self._waiting_since[user_id] = time.monotonic()
+        else:
+            self._pending.pop(user_id, None)
+            self._waiting_since.pop(user_id, None)
+
+    async def _run(self, user_id, superseded=None):
+        task = asyncio.current_task()
+        batch = None
+        try:
+            if superseded:
+                # let the cancelled run finish cleaning up its state before this one loads it
+                await asyncio.wait([superseded])
+            if self.coalesce_window:
+                await asyncio.sleep(self.coalesce_window)
+            batch = list(self._pending[user_id])
+            user_text = "\n".join(text for _, text, _ in batch)
+            response = await self.process(user_id, user_text)
+            # only drop what this run actually answered; anything newer is picked up by the next run
+            self._answered(user_id, batch[-1][0])
+            # a newer message may cancel this task now; the reply still has to go out
+            await asyncio.shield(batch[-1][2](response))
+        except asyncio.CancelledError:
+            # superseded by a newer message, whose run will include this batch
+            raise
+        except Exception as e:
+            print(f"Dispatch Error for {user_id}: {e}")
+            if batch:
+                self._answered(user_id, batch[-1][0])
+                try:
+                    await batch[-1][2](self.error_text)
+                except Exception as reply_error:
+                    print(f"Dispatch Reply Error for {user_id}: {reply_error}")
+        finally:
+            if self._tasks.get(user_id) is task:
+                del self._tasks[user_id]
+                if self._pending.get(user_id):
+                    # messages that queued behind this run
+                    self._tasks[user_id] = asyncio.create_task(self._run(user_id))
+                else:
+                    self._pending.pop(user_id, None)
+                    self._waiting_since.pop(user_id, None)
+                    self._superseded.pop(user_id, None)
+
+    async def drain(self):
+        """Wait for every in-flight run, e.g. before shutting down."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
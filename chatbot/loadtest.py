@@ -0,0 +1,291 @@
+"""Offline load test: drives the chatbot graph with synthetic Telegram updates
+against stub Groq and Supabase backends, and reports latency percentiles and
+throughput as concurrency increases.
+
+    python loadtest.py --concurrency 1,4,16,32 --requests 200
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import re
+import time
+from types import SimpleNamespace
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+# bot.py builds real clients at import time; give it harmless values, they get swapped for stubs below
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "stub.stub.stub")
+os.environ.setdefault("GROQ_API_KEY", "stub")
+
+import bot
+import metrics
+from dispatch import UserDispatcher
+
+MESSAGES = [
+    "Give me some high protein chicken recipes",
+    "I hate mushrooms and cilantro, what recipes can I make?",
+    "recipes for dinner please",
+    "I can't eat peanuts",
+    "hello!",
+    "more options",
+]
+INGREDIENTS = ["chicken breast", "ground beef", "salmon", "mushrooms", "cilantro", "rice", "black beans",
+               "greek yogurt", "eggs", "broccoli", "peanuts", "tofu", "milk", "spinach"]
+
+
+class StubBackend:
+    """Shared latency model for the stubs: each call sleeps mean * U(0.5, 1.5)."""
+
+    def __init__(self, mean_latency, seed):
+        self.mean_latency = mean_latency
+        self.rng = random.Random(seed)
+
+    def delay(self):
+        return self.mean_latency * self.rng.uniform(0.5, 1.5)
+
+    def wait(self):
+        time.sleep(self.delay())
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model that answers every structured-output schema bot.py uses.
+
+    It goes through the normal LangChain callback path and reports usage_metadata,
+    so TokenUsageHandler collects the token counts just as it does for ChatGroq.
+    """
+
+    backend: Any
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def with_structured_output(self, schema, **kwargs):
+        return self.bind(schema_name=schema.__name__) | RunnableLambda(lambda message: schema.model_validate_json(message.content))
+
+    def _generate(self, messages, stop=None, run_manager=None, schema_name=None, **kwargs):
+        self.backend.wait()
+        return self._respond(messages, schema_name)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, schema_name=None, **kwargs):
+        # like the real http call, the sleep is abandoned when a superseded run is cancelled
+        await asyncio.sleep(self.backend.delay())
+        return self._respond(messages, schema_name)
+
+    def _respond(self, messages, schema_name):
+        prompt = "\n".join(m.content for m in messages)
+        human = messages[-1].content
+        if schema_name == "UpdatePreferences":
+            result = bot.UpdatePreferences(new_dislikes=[i for i in INGREDIENTS if i in human and ("hate" in human or "can't" in human)])
+        elif schema_name == "UserIntent":
+            lowered = human.lower()
+            intent = "recipe" if "recipe" in lowered else "profile" if ("hate" in lowered or "can't" in lowered) else "other"
+            result = bot.UserIntent(intent=intent)
+        elif schema_name == "FilterResult":
+            rows = human.count("\n")
+            result = bot.FilterResult(safe_indices=[i for i in range(rows) if i % 3])
+        else:
+            names = re.findall(r"'name': '([^']*)'", human)
+            result = bot.PrettyResponse(recipe_text="Here are a few meals:\n" + "\n".join(names))
+        content = result.model_dump_json()
+        # roughly 4 characters per token, like the real tokenizer on english text
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        message = AIMessage(content=content, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"model_name": "stub-llm"})
+
+
+class StubQuery:
+    def __init__(self, supabase, table=None, rpc=None, params=None):
+        self.supabase = supabase
+        self.table_name = table
+        self.rpc_name = rpc
+        self.params = params or {}
+        self.filters = {}
+        self.row = None
+
+    def select(self, *columns):
+        return self
+
+    def eq(self, column, value):
+        self.filters[column] = value
+        return self
+
+    def upsert(self, row):
+        self.row = row
+        return self
+
+    insert = upsert
+
+    def execute(self):
+        self.supabase.backend.wait()
+        if self.rpc_name == "recommend_recipes":
+            return SimpleNamespace(data=self.supabase.recipe_page(self.params["offset_val"], self.params["limit_count"]))
+        if self.row is not None:
+            self.supabase.preferences[self.row["user_id"]] = self.row["dislikes"]
+            return SimpleNamespace(data=[self.row])
+        user_id = self.filters.get("user_id")
+        if user_id in self.supabase.preferences:
+            return SimpleNamespace(data=[{"user_id": user_id, "dislikes": self.supabase.preferences[user_id]}])
+        return SimpleNamespace(data=[])
+
+
+class StubSupabase:
+    def __init__(self, backend, total_recipes=None):
+        self.backend = backend
+        self.total_recipes = total_recipes  # None: the catalogue never runs out
+        self.preferences = {}
+
+    def table(self, name):
+        return StubQuery(self, table=name)
+
+    def rpc(self, name, params):
+        return StubQuery(self, rpc=name, params=params)
+
+    def recipe_page(self, offset, limit):
+        rng = random.Random(offset)
+        page = []
+        end = offset + limit if self.total_recipes is None else min(offset + limit, self.total_recipes)
+        for i in range(offset, end):
+            deals = rng.sample(INGREDIENTS, 4)
+            page.append({
+                "name": f"Recipe {i}",
+                "sale_details": [{"deal_name": d, "price": round(rng.uniform(1, 9), 2)} for d in deals],
+                "protein_g": rng.randint(40, 70),
+                "calories": rng.randint(400, 900),
+                "ingredient_on_sale": 4,
+                "total_ingredients": 8,
+            })
+        return page
+
+
+class FakeUser:
+    """Tracks which of a user's messages have been answered; one coalesced reply answers all earlier ones."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"user{user_id}"
+        self.sent = 0
+        self.answered = 0
+        self.changed = asyncio.Condition()
+
+    async def wait_for_reply(self, seq):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.answered >= seq)
+
+
+class FakeMessage:
+    def __init__(self, user, text):
+        self.text = text
+        self.from_user = user
+        user.sent += 1
+        self.seq = user.sent
+
+    async def reply_text(self, text, **kwargs):
+        user = self.from_user
+        async with user.changed:
+            user.answered = max(user.answered, self.seq)
+            user.changed.notify_all()
+
+
+def synthetic_update(user, text):
+    return SimpleNamespace(message=FakeMessage(user, text))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+async def run_level(concurrency, total_requests, users):
+    semaphore = asyncio.Semaphore(concurrency)
+    fake_users = [FakeUser(1000 + u) for u in range(users)]
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            update = synthetic_update(fake_users[i % users], MESSAGES[i % len(MESSAGES)])
+            start = time.perf_counter()
+            await bot.telegram_handler(update, None)
+            await update.message.from_user.wait_for_reply(update.message.seq)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total_requests)))
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def graph_runs():
+    return sum(count for (_, status), (count, _) in metrics.REQUEST_LATENCY.snapshot().items() if status == "ok")
+
+
+def print_node_summary():
+    print("\nper-node mean latency (all levels):")
+    for (node, status), (count, total) in sorted(metrics.NODE_LATENCY.snapshot().items()):
+        print(f"  {node:<20} {status:<6} n={count:<6} mean={total / count * 1000:8.1f} ms")
+    print("per-call mean latency (all levels):")
+    for (service, operation, status), (count, total) in sorted(metrics.EXTERNAL_CALL_LATENCY.snapshot().items()):
+        print(f"  {service + '.' + operation:<28} {status:<6} n={count:<6} mean={total / count * 1000:8.1f} ms")
+
+
+async def main(args):
+    backend_seed = args.seed
+    bot.llm = StubChatModel(backend=StubBackend(args.llm_latency, backend_seed), callbacks=[metrics.TokenUsageHandler()])
+    bot.supabase = StubSupabase(StubBackend(args.db_latency, backend_seed + 1))
+    bot.dispatcher = UserDispatcher(bot.run_chat, coalesce_window=args.coalesce_window,
+                                    rate=args.user_rate, burst=args.user_burst)
+    bot.conversations = bot.ConversationStore(args.checkpoint_db)
+    await bot.startup(None)
+    try:
+        await run_levels(args)
+    finally:
+        await bot.shutdown(None)
+
+
+async def run_levels(args):
+    print(f"{'concurrency':>11} {'requests':>8} {'graph runs':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for concurrency in args.concurrency:
+        runs_before = graph_runs()
+        # the bot prints on every node; keep the report readable unless asked otherwise
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            latencies, elapsed = await run_level(concurrency, args.requests, args.users)
+        print(f"{concurrency:>11} {len(latencies):>8} {graph_runs() - runs_before:>10} "
+              f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 95) * 1000:>9.1f} "
+              f"{percentile(latencies, 99) * 1000:>9.1f} {len(latencies) / elapsed:>8.2f}")
+
+    print_node_summary()
+    if args.dump_metrics:
+        print("\n" + metrics.REGISTRY.render())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--users", type=int, default=50, help="distinct synthetic telegram users")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="mean stub Groq latency in seconds")
+    parser.add_argument("--db-latency", type=float, default=0.03, help="mean stub Supabase latency in seconds")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--coalesce-window", type=float, default=0.0,
+                        help="seconds to wait for follow-up messages before running the graph")
+    parser.add_argument("--user-rate", type=float, default=1000.0, help="per-user messages/sec once the burst is spent")
+    parser.add_argument("--user-burst", type=int, default=1000)
+    parser.add_argument("--checkpoint-db", default=":memory:", help="sqlite path for the conversation checkpoints")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own prints while running")
+    parser.add_argument("--dump-metrics", action="store_true", help="print the Prometheus exposition at the end")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
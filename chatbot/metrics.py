@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# seconds, tuned for a mix of fast db calls and slow llm calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        """Return {label values: (count, sum)} for quick summaries."""
+        with self._lock:
+            return {key: (s[-2], s[-1]) for key, s in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _format_labels(self.label_names, key, ("le", bound))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.label_names, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {series[-2]}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_count{labels} {series[-2]}")
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+NODE_LATENCY = REGISTRY.histogram(
+    "shopper_node_latency_seconds",
+    "Time spent inside each StateGraph node.",
+    ("node", "status"),
+)
+EXTERNAL_CALL_LATENCY = REGISTRY.histogram(
+    "shopper_external_call_latency_seconds",
+    "Latency of calls to Supabase and Groq.",
+    ("service", "operation", "status"),
+)
+REQUEST_LATENCY = REGISTRY.histogram(
+    "shopper_request_latency_seconds",
+    "Time to run the graph for one (possibly coalesced) chat message.",
+    ("handler", "status"),
+)
+LLM_TOKENS = REGISTRY.counter(
+    "shopper_llm_tokens_total",
+    "Tokens consumed by LLM calls.",
+    ("model", "kind"),
+)
+DISPATCH_MESSAGES = REGISTRY.counter(
+    "shopper_dispatch_messages_total",
+    "Incoming chat messages by outcome: accepted or throttled.",
+    ("outcome",),
+)
+SUPERSEDED_RUNS = REGISTRY.counter(
+    "shopper_superseded_runs_total",
+    "Graph runs cancelled because a newer message from the same user arrived.",
+)
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observe the wall time of the block, labelled with status ok/error/cancelled."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - start, status=status, **labels)
+
+
+def track_call(service, operation):
+    return timer(EXTERNAL_CALL_LATENCY, service=service, operation=operation)
+
+
+def track_request(handler):
+    return timer(REQUEST_LATENCY, handler=handler)
+
+
+def instrument_node(fn):
+    """Decorator recording per-node latency. Keeps the name so langgraph registers it the same way."""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with timer(NODE_LATENCY, node=fn.__name__):
+                return await fn(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timer(NODE_LATENCY, node=fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def record_tokens(model, prompt_tokens, completion_tokens):
+    LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """LangChain callback hook that counts tokens for every chat model call it is attached to."""
+
+    def on_llm_end(self, response, **kwargs):
+        llm_output = response.llm_output or {}
+        model = llm_output.get("model_name", "unknown")
+        prompt_tokens = completion_tokens = 0
+        found = False
+        # prefer the standardised usage_metadata, fall back to the provider's token_usage
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+                    found = True
+        if not found:
+            usage = llm_output.get("token_usage")
+            if not usage:
+                # nothing reported, don't invent a zero row
+                return
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        record_tokens(model, prompt_tokens, completion_tokens)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown out the bot logs
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serve /metrics from a daemon thread so it never blocks the bot loop."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,95 @@
+"""Front router for running the bot as several workers behind a load balancer.
+
+Each worker keeps per-user state in its own process: the dispatcher's queues
+and rate limits, and the conversation checkpoints in its SQLite file. So every
+update from a user has to reach the same worker. Telegram posts all updates to
+one webhook URL, which points at this router. The router picks the worker
+from the sender's id and forwards the update to it unchanged. It keeps no
+state of its own, so any number of routers can sit behind the load balancer.
+
+    load balancer -> router (xN) -> ROUTER_WORKERS[user_id % len(ROUTER_WORKERS)]
+
+Each worker runs `BOT_MODE=webhook python bot.py` with its own PORT and its own
+CHECKPOINT_DB volume. WEBHOOK_URL and WEBHOOK_SECRET are the same for every
+worker and point at the public router URL. Every worker registers that URL
+at startup, and setWebhook with the same URL is harmless. Run the router with
+the same WEBHOOK_SECRET:
+
+    ROUTER_WORKERS=http://worker-0:8443/telegram,http://worker-1:8443/telegram \\
+        WEBHOOK_SECRET=... python router.py
+
+The Docker image runs the bot by default. Start the router from the same image with
+`python -u router.py` as the command.
+
+Changing the worker list moves most users to a different worker. Their
+"more" state stays behind until it expires, and they start a fresh search.
+"""
+import hmac
+import json
+import os
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_user_id(update):
+    """The id of the user an update came from, or 0 for updates without a sender (e.g. channel polls)."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        # messages, callback queries, inline queries... carry "from"; poll answers carry "user"
+        sender = value.get("from") or value.get("user") or value.get("chat") or {}
+        return int(sender.get("id", 0))
+    return 0
+
+
+def pick_worker(update, workers):
+    return workers[update_user_id(update) % len(workers)]
+
+
+class RouteHandler(RequestHandler):
+    def initialize(self, workers, secret):
+        self.workers = workers
+        self.secret = secret
+
+    async def post(self):
+        token = self.request.headers.get(SECRET_HEADER, "")
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            self.set_status(403)
+            return
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        worker = pick_worker(update, self.workers)
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers[SECRET_HEADER] = token
+        response = await AsyncHTTPClient().fetch(
+            HTTPRequest(worker, method="POST", body=self.request.body, headers=headers, request_timeout=30),
+            raise_error=False,
+        )
+        if response.code == 599:
+            # worker unreachable: a non-2xx makes Telegram retry the update later
+            print(f"Router Error forwarding to {worker}: {response.error}")
+            self.set_status(502)
+        else:
+            self.set_status(response.code)
+
+
+def make_app(workers, secret=None, path="telegram"):
+    return Application([(rf"/{path.strip('/')}/?", RouteHandler, {"workers": workers, "secret": secret})])
+
+
+if __name__ == '__main__':
+    workers = [url.strip() for url in os.getenv("ROUTER_WORKERS", "").split(",") if url.strip()]
+    if not workers:
+        raise SystemExit("ROUTER_WORKERS must list the worker webhook urls, comma separated")
+    port = int(os.getenv("ROUTER_PORT", "8080"))
+    make_app(workers, os.getenv("WEBHOOK_SECRET"), os.getenv("WEBHOOK_PATH", "telegram")).listen(port)
+    print(f"Routing webhook on port {port} across {len(workers)} workers...")
+    IOLoop.current().start()
@@ -0,0 +1,138 @@
+"""Local stand-in for the Telegram Bot API, for exercising webhook mode offline.
+
+Start the stand-in, then the bot pointed at it:
+
+    python telegram_standin.py --port 8081 --secret dev "give me chicken recipes" "actually no mushrooms"
+    TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_BOT_TOKEN=123:stub BOT_MODE=webhook \\
+        WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_SECRET=dev python bot.py
+
+Once the bot registers its webhook the stand-in posts the messages as Telegram
+updates and prints every reply the bot sends back.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Smart Shopper", "username": "smart_shopper_standin_bot"}
+
+
+class StandIn:
+    def __init__(self):
+        self.webhook_registered = threading.Event()
+        self.webhook_url = None
+        self.sent_messages = []
+        self.message_id = 0
+        self.lock = threading.Lock()
+
+    def call(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            print(f"[standin] webhook set to {self.webhook_url}")
+            self.webhook_registered.set()
+            return True
+        if method == "sendMessage":
+            with self.lock:
+                self.message_id += 1
+                self.sent_messages.append(params)
+                message_id = self.message_id
+            print(f"[standin] bot -> {params.get('chat_id')}: {params.get('text')}")
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        # deleteWebhook, setMyCommands, ... just succeed
+        return True
+
+
+def make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # paths look like /bot<token>/<method>
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params = json.loads(body or "{}")
+            else:
+                params = {}
+                for name, values in parse_qs(body).items():
+                    try:
+                        params[name] = json.loads(values[0])
+                    except ValueError:
+                        params[name] = values[0]
+            payload = json.dumps({"ok": True, "result": standin.call(method, params)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def synthetic_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def post_update(webhook_url, update, secret=None):
+    request = urllib.request.Request(webhook_url, data=json.dumps(update).encode(), method="POST")
+    request.add_header("Content-Type", "application/json")
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    with urllib.request.urlopen(request) as response:
+        return response.status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("messages", nargs="*", help="texts to send, in order, as one user")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook-url", help="where to post updates; defaults to the url the bot registers")
+    parser.add_argument("--secret", help="value for the X-Telegram-Bot-Api-Secret-Token header")
+    parser.add_argument("--user", type=int, default=42)
+    parser.add_argument("--gap", type=float, default=0.2, help="seconds between messages")
+    args = parser.parse_args()
+
+    standin = StandIn()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(standin))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[standin] Bot API listening on http://127.0.0.1:{args.port}")
+
+    if args.messages:
+        standin.webhook_registered.wait()
+        # give the webhook server a moment to start accepting after it registers
+        time.sleep(0.5)
+        for update_id, text in enumerate(args.messages, start=1):
+            print(f"[standin] {args.user} -> bot: {text}")
+            post_update(args.webhook_url or standin.webhook_url, synthetic_update(update_id, args.user, text), args.secret)
+            time.sleep(args.gap)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""Offline tests for the dispatcher, the graph's follow-up paging and the
+conversation store, run against the stubs in loadtest.py."""
+import asyncio
+import contextlib
+import re
+import time
+
+import pytest
+
+import loadtest  # sets the dummy env vars bot.py needs, so it comes before bot
+import bot
+import conversations
+import dispatch
+from dispatch import TokenBucket, UserDispatcher
+
+
+class Recorder:
+    """Collects replies sent through the dispatcher, with when they were sent."""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply(self, text):
+        self.replies.append((time.monotonic(), text))
+
+    @property
+    def texts(self):
+        return [text for _, text in self.replies]
+
+
+def echo_process(delay=0.0, calls=None):
+    async def process(user_id, text):
+        if calls is not None:
+            calls.append(text)
+        await asyncio.sleep(delay)
+        return f"answer to {text!r}"
+    return process
+
+
+# --- TokenBucket ---
+
+def test_token_bucket_allows_burst_then_refills(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(dispatch.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.take() and bucket.take()
+    assert not bucket.take()
+    now[0] += 2.0  # one token back at 0.5/s
+    assert bucket.take()
+    assert not bucket.take()
+
+
+# --- UserDispatcher ---
+
+def test_burst_is_coalesced_into_one_run():
+    async def scenario():
+        calls, recorder = [], Recorder()
+        dispatcher = UserDispatcher(echo_process(calls=calls), coalesce_window=0.05, rate=100, burst=100)
+        for text in ["one", "two", "three"]:
+            await dispatcher.submit(1, text, recorder.reply)
+        await dispatcher.drain()
+        return calls, recorder.texts
+
+    calls, replies = asyncio.run(scenario())
+    assert calls == ["one\ntwo\nthree"]
+    assert replies == ["answer to 'one\\ntwo\\nthree'"]
+
+
+def test_newer_message_cancels_in_flight_run():
+    async def scenario():
+        calls, recorder = [], Recorder()
+        dispatcher = UserDispatcher(echo_process(delay=0.2, calls=calls), coalesce_window=0, rate=100, burst=100)
+        await dispatcher.submit(1, "first", recorder.reply)
+        await asyncio.sleep(0.05)
+        await dispatcher.submit(1, "second", recorder.reply)
+        await dispatcher.drain()
+        return calls, recorder.texts
+
+    calls, replies = asyncio.run(scenario())
+    assert calls == ["first", "first\nsecond"]
+    assert replies == ["answer to 'first\\nsecond'"]
+
+
+def test_steady_sender_is_not_starved():
+    # one message every 0.15s against a 0.2s run: without a bound every message cancels the last run
+    async def scenario():
+        calls, recorder = [], Recorder()
+        dispatcher = UserDispatcher(echo_process(delay=0.2, calls=calls), coalesce_window=0.075,
+                                    rate=100, burst=100, max_supersedes=2, max_merged=3)
+        for i in range(12):
+            await dispatcher.submit(1, f"m{i}", recorder.reply)
+            await asyncio.sleep(0.15)
+        stopped = time.monotonic()
+        await dispatcher.drain()
+        return calls, recorder.replies, stopped
+
+    calls, replies, stopped = asyncio.run(scenario())
+    assert [t for t, _ in replies if t < stopped], "no reply until the sender stopped"
+    assert all(len(text.split("\n")) <= 3 for text in calls)
+    assert replies[-1][1].endswith("m11'")
+
+
+def test_only_the_last_messages_are_merged():
+    async def scenario():
+        calls, recorder = [], Recorder()
+        dispatcher = UserDispatcher(echo_process(calls=calls), coalesce_window=0.05, rate=100, burst=100, max_merged=2)
+        for text in ["a", "b", "c", "d"]:
+            await dispatcher.submit(1, text, recorder.reply)
+        await dispatcher.drain()
+        return calls
+
+    assert asyncio.run(scenario()) == ["c\nd"]
+
+
+def test_failed_run_sends_error_reply():
+    async def failing(user_id, text):
+        raise RuntimeError("groq is down")
+
+    async def scenario():
+        recorder = Recorder()
+        dispatcher = UserDispatcher(failing, coalesce_window=0, rate=100, burst=100, error_text="oops")
+        await dispatcher.submit(1, "hi", recorder.reply)
+        await dispatcher.drain()
+        return recorder.texts, dispatcher._pending
+
+    replies, pending = asyncio.run(scenario())
+    assert replies == ["oops"]
+    assert pending == {}
+
+
+def test_throttle_notice_once_per_refill(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(dispatch.time, "monotonic", lambda: now[0])
+
+    async def scenario():
+        dispatcher = UserDispatcher(echo_process(), coalesce_window=0, rate=1, burst=1)
+        accepted = [await dispatcher.submit(1, "hi", Recorder().reply)]
+        warnings = []
+        for _ in range(3):
+            accepted.append(await dispatcher.submit(1, "hi", Recorder().reply))
+            warnings.append(dispatcher.should_warn(1))
+        now[0] += 1.0
+        accepted.append(await dispatcher.submit(1, "hi", Recorder().reply))
+        accepted.append(await dispatcher.submit(1, "hi", Recorder().reply))
+        warnings.append(dispatcher.should_warn(1))
+        await dispatcher.drain()
+        return accepted, warnings
+
+    accepted, warnings = asyncio.run(scenario())
+    assert accepted == [True, False, False, False, True, False]
+    assert warnings == [True, False, False, True]
+
+
+# --- router ---
+
+def test_router_shards_by_sender():
+    from router import pick_worker, update_user_id
+
+    workers = ["http://w0/telegram", "http://w1/telegram", "http://w2/telegram"]
+    message = {"update_id": 1, "message": {"message_id": 1, "from": {"id": 7}, "chat": {"id": -100}, "text": "hi"}}
+    callback = {"update_id": 2, "callback_query": {"id": "q", "from": {"id": 7}, "data": "more"}}
+    poll_answer = {"update_id": 3, "poll_answer": {"poll_id": "p", "user": {"id": 8}}}
+    assert update_user_id(message) == update_user_id(callback) == 7
+    assert update_user_id(poll_answer) == 8
+    assert update_user_id({"update_id": 4}) == 0
+    assert pick_worker(message, workers) == pick_worker(callback, workers) == "http://w1/telegram"
+
+
+# --- graph state and follow-ups ---
+
+@pytest.fixture
+def stub_bot(monkeypatch):
+    """bot.py wired to the load test stubs and an in-memory checkpoint store; call bot.startup inside the test."""
+    monkeypatch.setattr(bot, "llm", loadtest.StubChatModel(backend=loadtest.StubBackend(0.0, 1)))
+    monkeypatch.setattr(bot, "supabase", loadtest.StubSupabase(loadtest.StubBackend(0.0, 2), total_recipes=120))
+    monkeypatch.setattr(bot, "conversations", bot.ConversationStore(":memory:"))
+    monkeypatch.setattr(bot, "app_graph", bot.app_graph)  # startup recompiles it
+    return bot
+
+
+def test_reducers():
+    assert bot.extend_or_reset([1, 2], [3]) == [1, 2, 3]
+    assert bot.extend_or_reset([1, 2], None) == []
+    assert bot.merge_unique(["milk", "eggs"], ["eggs", "tofu"]) == ["milk", "eggs", "tofu"]
+
+
+@pytest.mark.parametrize("text", ["more", "More!", "show me more options", "next please", "any other recipes?",
+                                  "give me some different ones"])
+def test_follow_up_pattern_matches(text):
+    assert bot.FOLLOW_UP_PATTERN.match(text)
+
+
+@pytest.mark.parametrize("text", ["more chicken recipes", "I hate mushrooms", "recipes for dinner please", ""])
+def test_follow_up_pattern_ignores(text):
+    assert not bot.FOLLOW_UP_PATTERN.match(text)
+
+
+def test_follow_up_conditional():
+    cached = {"supabase_offset": 100, "matched_recipes": [{}] * 10}
+    assert bot.follow_up_conditional({"user_text": "more"}) == "profile_node"
+    assert bot.follow_up_conditional({**cached, "user_text": "more", "shown_count": 5}) == "final_recipes_node"
+    assert bot.follow_up_conditional({**cached, "user_text": "more", "shown_count": 10}) == "database_node"
+    assert bot.follow_up_conditional({**cached, "user_text": "no eggs", "shown_count": 5}) == "profile_node"
+
+
+def test_pagination_walks_every_recipe_then_stops(stub_bot):
+    async def scenario():
+        await bot.startup(None)
+        try:
+            with contextlib.redirect_stdout(None):
+                replies = [await bot.run_chat(1, "recipes for dinner please")]
+                state = await bot.app_graph.aget_state(bot.conversations.config(1))
+                cached = len(state.values["matched_recipes"])
+                while not replies[-1].startswith("That's everything") and len(replies) < 50:
+                    replies.append(await bot.run_chat(1, "more"))
+            return replies, cached
+        finally:
+            await bot.conversations.close()
+
+    replies, cached = asyncio.run(scenario())
+    assert bot.CACHE_FILL_TARGET <= cached <= bot.CACHE_FILL_TARGET + bot.RECIPE_PAGE_SIZE - 1
+    shown = [name for reply in replies for name in re.findall(r"Recipe \d+", reply)]
+    assert shown == [f"Recipe {i}" for i in range(120)]
+    assert replies[-1].startswith("That's everything I found")
+
+
+def test_cancelled_run_leaves_no_checkpoint(stub_bot):
+    stub_bot.llm.backend.mean_latency = 0.05
+
+    async def scenario():
+        await bot.startup(None)
+        try:
+            with contextlib.redirect_stdout(None):
+                await bot.run_chat(1, "recipes for dinner please")
+                loaded = await bot.conversations.latest_checkpoint(1)
+                # cancel while the intent call runs, after the profile node has finished
+                run = asyncio.create_task(bot.run_chat(1, "I hate eggs and tofu"))
+                await asyncio.sleep(0.09)
+                run.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await run
+            state = await bot.app_graph.aget_state(bot.conversations.config(1))
+            return loaded, await bot.conversations.latest_checkpoint(1), state
+        finally:
+            await bot.conversations.close()
+
+    loaded, latest, state = asyncio.run(scenario())
+    assert latest == loaded
+    assert state.values["user_text"] == "recipes for dinner please"
+    assert state.next == ()
+
+
+# --- ConversationStore ---
+
+def test_store_prunes_expired_and_least_recent(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(conversations.time, "time", lambda: now[0])
+
+    async def threads(store):
+        async with store.saver.conn.execute("SELECT thread_id FROM thread_activity ORDER BY thread_id") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def scenario():
+        store = conversations.ConversationStore(":memory:", ttl=100, max_threads=2)
+        await store.open()
+        try:
+            for user_id, seen in [(1, 1000), (2, 1050), (3, 1060), (4, 1070)]:
+                now[0] = seen
+                await store.touch(user_id)
+            now[0] = 1120.0  # user 1 is past the ttl, and user 2 is the oldest of the rest
+            with contextlib.redirect_stdout(None):
+                await store.prune()
+            after_prune = await threads(store)
+            now[0] = 1165.0  # user 3 is now stale, user 4 isn't yet
+            await store.expire_if_stale(3)
+            await store.expire_if_stale(4)
+            return after_prune, await threads(store)
+        finally:
+            await store.close()
+
+    after_prune, after_expire = asyncio.run(scenario())
+    assert after_prune == ["3", "4"]
+    assert after_expire == ["4"]